@@ -0,0 +1,64 @@
+import json
+import math
+import sqlite3
+import time
+from pathlib import Path
+
+# -------------------------------------------------------------------
+# Semantic cache for agent outputs
+# -------------------------------------------------------------------
+# Stores (agent name, prompt, embedding, output) rows in SQLite and answers
+# lookups by cosine similarity against prompts previously sent to the
+# same agent. Meant for whole-pipeline results, so the table stays small
+# and a linear scan is cheap compared to a single LLM call.
+
+
+def cosine_similarity(a: list[float], b: list[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class LLMCache:
+    def __init__(self, path="llm_cache.sqlite3", threshold=0.92, ttl=24 * 3600):
+        self.path = Path(path)
+        self.threshold = threshold
+        self.ttl = ttl
+        self._conn = sqlite3.connect(self.path)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                agent TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                embedding TEXT NOT NULL,
+                output TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def get(self, agent_name: str, embedding: list[float]) -> str | None:
+        """Return the cached output of the most similar fresh prompt, or None."""
+        now = time.time()
+        self._conn.execute("DELETE FROM llm_cache WHERE expires_at < ?", (now,))
+        self._conn.commit()
+        rows = self._conn.execute(
+            "SELECT embedding, output FROM llm_cache WHERE agent = ?", (agent_name,)
+        ).fetchall()
+
+        best_score, best_output = 0.0, None
+        for stored, output in rows:
+            score = cosine_similarity(embedding, json.loads(stored))
+            if score > best_score:
+                best_score, best_output = score, output
+
+        return best_output if best_score > self.threshold else None
+
+    def set(self, agent_name: str, prompt: str, embedding: list[float], output: str, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        self._conn.execute(
+            "INSERT INTO llm_cache (agent, prompt, embedding, output, expires_at) VALUES (?, ?, ?, ?, ?)",
+            (agent_name, prompt, json.dumps(embedding), output, expires_at),
+        )
+        self._conn.commit()
@@ -1,237 +1,458 @@
 import os
 import time
-import pathlib
+import hashlib
+import random
+import asyncio
+import argparse
+import weakref
+import httpx
+from collections import OrderedDict, deque
+from functools import lru_cache
+from pathlib import Path
 from dotenv import load_dotenv, find_dotenv
 from datetime import datetime
 
 from agents import Agent, Runner, AsyncOpenAI, OpenAIChatCompletionsModel, function_tool
+from openai import RateLimitError
 from tavily import AsyncTavilyClient
 
+from llm_cache import LLMCache
+
 # -------------------------------------------------------------------
 # 1. Load environment variables
 # -------------------------------------------------------------------
-load_dotenv(find_dotenv())
+# Everything below is built lazily on first use, so importing this module
+# does no I/O and tests can set env vars before any client exists.
+@lru_cache(maxsize=1)
+def load_env() -> None:
+    load_dotenv(find_dotenv())
+
 
-# Gemini key for LLMs
-gemini_api_key = os.getenv("GEMINI_API_KEY", "")
+@lru_cache(maxsize=1)
+def get_tavily() -> AsyncTavilyClient:
+    # Tavily key for search
+    load_env()
+    return AsyncTavilyClient(api_key=os.environ.get("TAVILY_API_KEY"))
 
-# Tavily key for search
-# tavily_api_key = os.environ.get("TAVILY_API_KEY", "")
-tavily_api_key = os.environ.get("TAVILY_API_KEY")
-tavily_client = AsyncTavilyClient(api_key=tavily_api_key)
- 
 
 # -------------------------------------------------------------------
 # 2. LLM Clients
 # -------------------------------------------------------------------
-external_client: AsyncOpenAI = AsyncOpenAI(
-    api_key=gemini_api_key,
-    base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
-)
+# One pooled HTTP/2 client shared by every model, so concurrent agent calls
+# reuse TLS sessions instead of opening a new connection each time.
+@lru_cache(maxsize=1)
+def get_http_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        # Short connect, but keep the OpenAI SDK's 600s read budget for long completions.
+        timeout=httpx.Timeout(60.0, read=600.0),
+    )
+
+
+@lru_cache(maxsize=1)
+def get_external_client() -> AsyncOpenAI:
+    # Gemini key for LLMs
+    load_env()
+    return AsyncOpenAI(
+        api_key=os.getenv("GEMINI_API_KEY", ""),
+        base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
+        http_client=get_http_client(),
+    )
+
+
+@lru_cache(maxsize=1)
+def get_light_model() -> OpenAIChatCompletionsModel:
+    return OpenAIChatCompletionsModel(model="gemini-2.5-flash-lite", openai_client=get_external_client())
 
-light_model: OpenAIChatCompletionsModel = OpenAIChatCompletionsModel(
-    model="gemini-2.5-flash-lite", openai_client=external_client
-)
 
-llm_model: OpenAIChatCompletionsModel = OpenAIChatCompletionsModel(
-    model="gemini-2.5-flash", openai_client=external_client
-)
+@lru_cache(maxsize=1)
+def get_llm_model() -> OpenAIChatCompletionsModel:
+    return OpenAIChatCompletionsModel(model="gemini-2.5-flash", openai_client=get_external_client())
+
+
+@lru_cache(maxsize=1)
+def get_special_model() -> OpenAIChatCompletionsModel:
+    return OpenAIChatCompletionsModel(model="gemini-2.5-pro", openai_client=get_external_client())
 
-special_model: OpenAIChatCompletionsModel = OpenAIChatCompletionsModel(
-    model="gemini-2.5-pro", openai_client=external_client
-)
 
 # -------------------------------------------------------------------
 # 3. Web Search Tool (Tavily with Rate Limiting)
 # -------------------------------------------------------------------
 
-last_call_time = 0
+TAVILY_MAX_CALLS = 10  # Tavily free tier: 10 calls/min
+TAVILY_WINDOW = 60.0
+SNIPPET_CHARS = 280  # per-result snippet budget handed back to the LLM
+SEARCH_CACHE_TTL = 900.0
+SEARCH_CACHE_SIZE = 256
 
+# asyncio.Lock is bound to the loop it is first used on, so keep one per loop;
+# the call window itself is shared by the whole process.
+_tavily_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
+_tavily_calls: deque[float] = deque()
+_search_cache: OrderedDict[tuple[str, int], tuple[float, str]] = OrderedDict()
 
-@function_tool
-async def web_search(query: str, max_results: int = 5) -> str:
+
+async def _tavily_slot() -> None:
     """
-    Perform a real web search using Tavily API (rate-limited to 10 calls/min).
-    Returns formatted results with title, URL, and snippet/content.
+    Wait (without blocking the event loop) until a Tavily call fits in the
+    sliding 60s window. Up to TAVILY_MAX_CALLS calls may be in flight per window.
     """
-    global last_call_time
-    elapsed = time.time() - last_call_time
-    if elapsed < 6:  # 10 calls/min limit => 1 call every 6s
-        time.sleep(6 - elapsed)
-
-    last_call_time = time.time()
+    loop = asyncio.get_running_loop()
+    lock = _tavily_locks.get(loop)
+    if lock is None:
+        lock = _tavily_locks[loop] = asyncio.Lock()
+
+    async with lock:
+        while True:
+            now = time.monotonic()
+            while _tavily_calls and now - _tavily_calls[0] >= TAVILY_WINDOW:
+                _tavily_calls.popleft()
+            if len(_tavily_calls) < TAVILY_MAX_CALLS:
+                _tavily_calls.append(now)
+                return
+            await asyncio.sleep(TAVILY_WINDOW - (now - _tavily_calls[0]))
+
+
+async def _search(query: str, max_results: int = 5) -> str:
+    """Run one rate-limited Tavily query and format the hits for the LLM."""
+    key = (query.strip().lower(), max_results)
+    cached = _search_cache.get(key)
+    if cached and time.monotonic() - cached[0] < SEARCH_CACHE_TTL:
+        _search_cache.move_to_end(key)
+        return cached[1]
+
+    await _tavily_slot()
 
     try:
-        results = await tavily_client.search(query=query, max_results=max_results)
-        print("DEBUG Tavily response:", results)  #  log raw response
+        results = await get_tavily().search(query=query, max_results=max_results)
 
-        if "results" not in results or not results["results"]:
-            return "No results found."
+        # Best-scored hits first, clipped snippets, empty ones dropped:
+        # everything returned here is re-sent as input to later agents.
+        # An empty answer is a valid result and is cached like any other.
+        hits = results.get("results") or []
+        top = sorted(hits, key=lambda r: r.get("score", 0), reverse=True)[:max_results]
 
         formatted = []
-        for r in results["results"]:
+        for r in top:
+            snippet = (r.get("snippet") or r.get("content") or "")[:SNIPPET_CHARS]
+            if not snippet:
+                continue
             title = r.get("title", "No Title")
             url = r.get("url", "No URL")
-            snippet = r.get("snippet") or r.get("content") or "No snippet available"
             formatted.append(f"- {title} ({url}): {snippet}")
 
-        return "\n".join(formatted)
+        output = "\n".join(formatted) or "No results found."
+        _search_cache[key] = (time.monotonic(), output)
+        _search_cache.move_to_end(key)
+        if len(_search_cache) > SEARCH_CACHE_SIZE:
+            _search_cache.popitem(last=False)
+        return output
 
     except Exception as e:
         return f"WebSearchTool failed: {str(e)}"
 
 
-# -------------------------------------------------------------------
-# 4. Utility Tool
-# -------------------------------------------------------------------
+async def _search_many(queries: list[str], max_results: int = 5) -> str:
+    """Run a batch of Tavily queries concurrently, grouped per query."""
+    # Same normalization as the search cache, so duplicates in one batch
+    # do not race past the cache and each take a rate-limit slot.
+    unique: dict[str, str] = {}
+    for q in queries:
+        unique.setdefault(q.strip().lower(), q)
+    queries = list(unique.values())
+    results = await asyncio.gather(*(_search(q, max_results) for q in queries))
+    return "\n\n".join(f"### {q}\n{r}" for q, r in zip(queries, results))
+
+
 @function_tool
-def current_date() -> str:
-    return datetime.now().strftime("%Y-%m-%d")
+async def web_search(query: str, max_results: int = 5) -> str:
+    """
+    Perform a real web search using Tavily API (rate-limited to 10 calls/min).
+    Returns formatted results with title, URL, and snippet/content.
+    """
+    return await _search(query, max_results)
+
+
+@function_tool
+async def web_search_many(queries: list[str], max_results: int = 5) -> str:
+    """
+    Run several web searches concurrently using Tavily API (shared 10 calls/min limit).
+    Prefer this over repeated web_search calls when you have multiple subqueries.
+    Returns formatted results grouped per query.
+    """
+    return await _search_many(queries, max_results)
+
 
 # -------------------------------------------------------------------
-# 5. Agents
+# 4. Agents
 # -------------------------------------------------------------------
-websearch_agent: Agent = Agent(
-    name="WebSearchAgent",
-    instructions="You are a helpful web search assistant. Use web search to find relevant information and return results with citations.",
-    model=llm_model,
-    tools=[web_search],
-)
-
-reflection_agent: Agent = Agent(
-    name="ReflectionAgent",
-    instructions="You are a helpful reflection assistant. Use reflective listening to decide if the research goal is complete.",
-    model=light_model,
-    tools=[],
-)
-
-planning_agent: Agent = Agent(
-    name="PlanningAgent",
-    instructions="You are a helpful planning assistant. Plan the research process step by step using scientific methods. Always explain the principles you used.",
-    model=special_model,
-    tools=[],
-)
-
-synthesis_agent = Agent(
-    name="synthesis_agent",
-    instructions="""
-    Your job is to review all research notes and sources,
-    merge overlapping findings, resolve contradictions,
-    and create a clear, structured summary.
-    - Group insights into categories
-    - Remove duplicates
-    - Flag uncertainties
-    - Keep track of citations
-    Return a clean knowledge base for the report writer.
-    """,
-    model=light_model,
-    tools=[],
-)
-
-report_writer_agent = Agent(
-    name="report_writer_agent",
-    instructions="""
-    You are the Report Writer Agent.
-    Using the structured insights from the synthesis_agent,
-    produce a professional research report.
-    - Add an executive summary
-    - Organize with clear sections & subheadings
-    - Insert citations inline (with URLs)
-    - End with a conclusion and a references section
-    Write in a professional, academic style, suitable for clients or publication.
-    """,
-    model=light_model,
-    tools=[],
-)
-
-orchestrator_agent: Agent = Agent(
-    name="OrchestratorAgent",
-    instructions="""
-       You are the Orchestrator Agent.
-    Process for each deep research request:
-
-    1. Get current date
-    2. Ask the planning_agent to create a research plan
-    3. Delegate web search tasks to websearch_agent
-    4. Use reflection_agent to verify sufficiency & credibility of results
-    5. Pass collected findings to synthesis_agent to merge & organize
-    6. Finally, pass synthesized insights to report_writer_agent to draft the final report
-
-    Always ensure the final output includes citations and is well-structured.
-    Stop the workflow once the report is written.
-
-Stopping rules:
-- When you have gathered enough evidence to answer the request, summarize and END the task immediately.
-- Do not continue asking the search agent once you can provide a reasonable, well-cited answer.
-- Never exceed 7 total exchanges with other agents. If the goal is not fully achieved by then, provide the best summary you can and stop.
-
-    """,
-    model=llm_model,
-    tools=[
-        current_date,
-        planning_agent.as_tool("PlanningTool", "Planning assistant with scientific reasoning"),
-        reflection_agent.as_tool("ReflectionTool", "Reflection assistant"),
-        websearch_agent.as_tool("WebSearchTool", "Real web search assistant with citations"),
-        report_writer_agent.as_tool("ReportWriterTool", "Creates the final polished research report with citations"),
-        synthesis_agent.as_tool("SynthesisTool", "Merges and organizes research findings"),
-    ],
-)
+@lru_cache(maxsize=1)
+def build_agents() -> dict[str, Agent]:
+    """Build the agent team once, keyed by role."""
+    # Resolved once per process and baked into the orchestrator prompt, so
+    # the model never spends a turn calling a tool to ask for it.
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    websearch_agent: Agent = Agent(
+        name="WebSearchAgent",
+        instructions="You are a helpful web search assistant. Use web search to find relevant information and return results with citations (only URLs from the search results; never invent sources). When you have several queries, run them together in one web_search_many call.",
+        model=get_llm_model(),
+        tools=[web_search, web_search_many],
+    )
+
+    reflection_agent: Agent = Agent(
+        name="ReflectionAgent",
+        instructions="""
+        You are a helpful reflection assistant. You are asked to judge one of two things:
+        - A research plan: decide whether it is deep enough for the request. Start your answer with
+          "PLAN OK" or "PLAN TOO SHALLOW", followed by a short reason.
+        - Collected findings: use reflective listening to decide if the research goal is complete.
+        """,
+        model=get_light_model(),
+        tools=[],
+    )
+
+    planning_agent: Agent = Agent(
+        name="PlanningAgent",
+        instructions="You are a helpful planning assistant. Plan the research process step by step using scientific methods. Always explain the principles you used.",
+        model=get_llm_model(),
+        tools=[],
+    )
+
+    # Same planner on the Pro model, only used when the first plan is rejected.
+    planning_agent_pro: Agent = planning_agent.clone(name="PlanningAgentPro", model=get_special_model())
+
+    synthesis_agent = Agent(
+        name="synthesis_agent",
+        instructions="""
+        Your job is to review all research notes and sources,
+        merge overlapping findings, resolve contradictions,
+        and create a clear, structured summary.
+        - Group insights into categories
+        - Remove duplicates
+        - Flag uncertainties
+        - Keep track of citations (never invent sources)
+        Return a clean knowledge base for the report writer.
+        """,
+        model=get_light_model(),
+        tools=[],
+    )
+
+    report_writer_agent = Agent(
+        name="report_writer_agent",
+        instructions="""
+        You are the Report Writer Agent.
+        Using the structured insights from the synthesis_agent,
+        produce a professional research report.
+        If you are given raw research notes instead, first merge duplicates and
+        group the findings yourself (synthesize-and-write), then write the report.
+        - Add an executive summary
+        - Organize with clear sections & subheadings
+        - Insert citations inline (with URLs from the research notes; never invent sources)
+        - End with a conclusion and a references section
+        Write in a professional, academic style, suitable for clients or publication.
+        """,
+        model=get_light_model(),
+        tools=[],
+    )
+
+    orchestrator_agent: Agent = Agent(
+        name="OrchestratorAgent",
+        instructions=f"""
+           You are the Orchestrator Agent.
+        Process for each deep research request:
+
+        1. Ask the planning_agent to create a research plan (PlanningTool)
+        2. Ask reflection_agent to review the plan (ReflectionTool). If it answers "PLAN TOO SHALLOW",
+           re-plan once with PlanningToolPro and use that plan without reviewing it again.
+        3. Delegate web search tasks to websearch_agent (issue all subqueries in a single WebSearchTool call)
+        4. Use reflection_agent to verify sufficiency & credibility of results
+        5. Pass collected findings to synthesis_agent to merge & organize
+        6. Finally, pass synthesized insights to report_writer_agent to draft the final report
+
+        Small evidence shortcut: if the collected search results total fewer than ~2000 tokens
+        (roughly 1500 words / 8000 characters), skip SynthesisTool and call ReportWriterTool
+        directly with the raw findings and the instruction "synthesize-and-write".
+
+        Always ensure the final output includes citations and is well-structured.
+        Stop the workflow once the report is written.
+
+    Stopping rules:
+    - When you have gathered enough evidence to answer the request, summarize and END the task immediately.
+    - Do not continue asking the search agent once you can provide a reasonable, well-cited answer.
+    - Never exceed 8 total exchanges with other agents. If the goal is not fully achieved by then, provide the best summary you can and stop.
+    - Exchange budget (8 tool calls): plan 1, plan review 1, Pro re-plan 0-1, search at most 2,
+      evidence check 1, synthesize 0-1, report 1.
+      Count your calls before each one; once a category is used up, move on to the next step.
+
+        Today's date is {today}.
+        """,
+        model=get_llm_model(),
+        # Sorted by name so the serialized tool schema is stable between runs.
+        tools=[
+            planning_agent.as_tool("PlanningTool", "Planning assistant with scientific reasoning"),
+            planning_agent_pro.as_tool("PlanningToolPro", "Deeper planning assistant; only for plans rejected as too shallow"),
+            reflection_agent.as_tool("ReflectionTool", "Reflection assistant"),
+            report_writer_agent.as_tool("ReportWriterTool", "Creates the final polished research report with citations"),
+            synthesis_agent.as_tool("SynthesisTool", "Merges and organizes research findings"),
+            websearch_agent.as_tool("WebSearchTool", "Real web search assistant with citations"),
+        ],
+    )
+
+    return {
+        "websearch": websearch_agent,
+        "reflection": reflection_agent,
+        "planning": planning_agent,
+        "planning_pro": planning_agent_pro,
+        "synthesis": synthesis_agent,
+        "report_writer": report_writer_agent,
+        "orchestrator": orchestrator_agent,
+    }
 
 
 # -------------------------------------------------------------------
-# 6. Run Deep Research
+# 5. Run Deep Research
 # -------------------------------------------------------------------
 
-# Throttled wrapper for Runner.run_sync
-def throttled_run_sync(agent, prompt):
-    time.sleep(7)  # pause ~7s before each call
-    return Runner.run_sync(agent, prompt)
+#  Retry wrapper with backoff
+MAX_BACKOFF = 60.0
+MAX_RETRY_ELAPSED = 300.0  # stop once 5 minutes have been spent waiting to retry
 
 
-#  Retry wrapper with backoff
-import time
-from openai import RateLimitError
+def retry_delay(e: Exception, attempt: int, base_delay: float) -> float:
+    """
+    Full-jitter exponential backoff, but never sooner than the server's
+    Retry-After hint when the error carries one.
+    """
+    wait_time = random.uniform(0, min(MAX_BACKOFF, base_delay * (2 ** attempt)))
+    response = getattr(e, "response", None)
+    if response is not None:
+        try:
+            wait_time = max(wait_time, float(response.headers.get("retry-after", 0)))
+        except (TypeError, ValueError):
+            pass  # HTTP-date form or garbage: fall back to jittered backoff
+    return wait_time
 
 
-def safe_run_sync(agent, prompt, max_turns=10, max_retries=5, base_delay=5):
+async def safe_run(agent, prompt, max_turns=10, max_retries=5, base_delay=5):
+    waited = 0.0  # time spent sleeping between retries, not running the pipeline
     attempt = 0
-    while attempt < max_retries:
+    while True:
         try:
-            return Runner.run_sync(agent, prompt, max_turns=max_turns)
-        except RateLimitError as e:
-            wait_time = base_delay * (2 ** attempt)  # exponential backoff
-            print(f"Rate limit hit (attempt {attempt+1}). Retrying in {wait_time}s...")
-            time.sleep(wait_time)
-            attempt += 1
+            return await Runner.run(agent, prompt, max_turns=max_turns)
         except Exception as e:
-            if "RESOURCE_EXHAUSTED" in str(e) or "429" in str(e):
-                wait_time = base_delay * (2 ** attempt)
-                print(f"Gemini quota exceeded (attempt {attempt+1}). Retrying in {wait_time}s...")
-                time.sleep(wait_time)
-                attempt += 1
+            if isinstance(e, RateLimitError):
+                reason = "Rate limit hit"
+            elif "RESOURCE_EXHAUSTED" in str(e) or "429" in str(e):
+                reason = "Gemini quota exceeded"
             else:
                 raise
-    raise Exception("Too many retries, giving up.")
 
+            wait_time = retry_delay(e, attempt, base_delay)
+            if attempt + 1 >= max_retries or waited + wait_time > MAX_RETRY_ELAPSED:
+                raise Exception("Too many retries, giving up.") from e
+            print(f"{reason} (attempt {attempt+1}). Retrying in {wait_time:.1f}s...")
+            await asyncio.sleep(wait_time)
+            waited += wait_time
+            attempt += 1
 
 
-# Now call it here
-result = safe_run_sync(
-    orchestrator_agent,
-    "Do deep search for a lead generation system for a professiona business services consultancy.",
-    max_turns=20
-)
+# -------------------------------------------------------------------
+# 6. Semantic cache around full runs
+# -------------------------------------------------------------------
+EMBEDDING_MODEL = "text-embedding-004"
 
-print(result.final_output)
 
-# result = safe_run_sync(...)  # or however you call Runner now
-report_text = result.final_output
+@lru_cache(maxsize=1)
+def get_llm_cache() -> LLMCache:
+    return LLMCache()
 
-# Save to disk
-from pathlib import Path
-out_path = Path("lead_generation_business_consultancy_report.md").resolve()
-out_path.write_text(report_text, encoding="utf-8")
-print(f"\nReport saved to: {out_path}\n")
 
-# Optionally print only the report (no debug)
-print(report_text)
\ No newline at end of file
+async def embed(text: str) -> list[float]:
+    response = await get_external_client().embeddings.create(model=EMBEDDING_MODEL, input=text)
+    return response.data[0].embedding
+
+
+def cache_key(agent) -> str:
+    """
+    Agent name plus a digest of its instructions, model and tool names, so a
+    changed prompt or setup never serves reports produced by the old one.
+    """
+    model = getattr(agent.model, "model", agent.model)
+    tools = ",".join(sorted(tool.name for tool in agent.tools))
+    digest = hashlib.sha256(f"{model}\n{tools}\n{agent.instructions}".encode("utf-8")).hexdigest()
+    return f"{agent.name}:{digest[:16]}"
+
+
+async def cached_run(agent, prompt, use_cache=True, **kwargs) -> str:
+    """
+    Run the agent through safe_run, reusing a previous final output when a
+    semantically similar prompt was already answered by the same agent setup.
+    The cache is always on unless use_cache is False (--no-cache); sampled
+    outputs are reused as-is, not re-generated.
+    """
+    if not use_cache:
+        return (await safe_run(agent, prompt, **kwargs)).final_output
+
+    try:
+        embedding = await embed(prompt)
+    except Exception as e:
+        print(f"Embedding failed, running without cache: {e}")
+        return (await safe_run(agent, prompt, **kwargs)).final_output
+
+    key = cache_key(agent)
+    cached = get_llm_cache().get(key, embedding)
+    if cached is not None:
+        print("Semantic cache hit, reusing previous report.")
+        return cached
+
+    result = await safe_run(agent, prompt, **kwargs)
+    get_llm_cache().set(key, prompt, embedding, str(result.final_output))
+    return result.final_output
+
+
+async def close_clients() -> None:
+    """
+    Close the pooled HTTP client and forget every cached object built on it,
+    so a later run (possibly on a new event loop) starts from fresh clients.
+    """
+    if get_http_client.cache_info().currsize:
+        await get_http_client().aclose()
+    for getter in (
+        build_agents,
+        get_light_model,
+        get_llm_model,
+        get_special_model,
+        get_external_client,
+        get_http_client,
+        get_tavily,
+    ):
+        getter.cache_clear()
+
+
+async def main(use_cache=True):
+    try:
+        # Now call it here
+        report_text = await cached_run(
+            build_agents()["orchestrator"],
+            "Do deep search for a lead generation system for a professiona business services consultancy.",
+            use_cache=use_cache,
+            max_turns=10  # 8 tool calls + final answer, with one turn of headroom
+        )
+    finally:
+        await close_clients()
+
+    print(report_text)
+
+    # Save to disk (off the event loop)
+    out_path = Path("lead_generation_business_consultancy_report.md").resolve()
+    await asyncio.to_thread(out_path.write_text, report_text, "utf-8")
+    print(f"\nReport saved to: {out_path}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deep research agentic system")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the semantic response cache")
+    args = parser.parse_args()
+    asyncio.run(main(use_cache=not args.no_cache))
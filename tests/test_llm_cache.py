@@ -0,0 +1,54 @@
+import time
+
+import pytest
+
+from llm_cache import LLMCache, cosine_similarity
+
+
+def test_cosine_similarity():
+    assert cosine_similarity([1, 0], [1, 0]) == pytest.approx(1.0)
+    assert cosine_similarity([1, 0], [0, 1]) == pytest.approx(0.0)
+    assert cosine_similarity([1, 0], [-1, 0]) == pytest.approx(-1.0)
+    assert cosine_similarity([0, 0], [1, 0]) == 0.0
+
+
+def test_get_returns_similar_prompt_for_same_agent():
+    cache = LLMCache(":memory:")
+    cache.set("agent", "prompt", [1.0, 0.0, 0.0], "report")
+
+    assert cache.get("agent", [0.99, 0.05, 0.0]) == "report"
+    assert cache.get("agent", [0.0, 1.0, 0.0]) is None
+    assert cache.get("other_agent", [1.0, 0.0, 0.0]) is None
+
+
+def test_get_picks_most_similar_entry():
+    cache = LLMCache(":memory:")
+    cache.set("agent", "a", [1.0, 0.0], "first")
+    cache.set("agent", "b", [0.0, 1.0], "second")
+
+    assert cache.get("agent", [0.1, 1.0]) == "second"
+
+
+def test_expired_entries_are_purged_and_committed(tmp_path):
+    path = tmp_path / "cache.sqlite3"
+    cache = LLMCache(path)
+    cache.set("agent", "stale", [1.0, 0.0], "old", ttl=-1)
+    cache.set("agent", "fresh", [0.0, 1.0], "new")
+
+    assert cache.get("agent", [1.0, 0.0]) is None
+    assert cache.get("agent", [0.0, 1.0]) == "new"
+    assert not cache._conn.in_transaction
+    cache._conn.close()
+
+    reopened = LLMCache(path)
+    rows = reopened._conn.execute("SELECT prompt FROM llm_cache").fetchall()
+    assert rows == [("fresh",)]
+
+
+def test_default_ttl_expires(monkeypatch):
+    cache = LLMCache(":memory:", ttl=10)
+    cache.set("agent", "prompt", [1.0], "report")
+
+    real_time = time.time
+    monkeypatch.setattr(time, "time", lambda: real_time() + 11)
+    assert cache.get("agent", [1.0]) is None
@@ -0,0 +1,169 @@
+import asyncio
+import random
+import time
+
+import httpx
+import pytest
+from openai import RateLimitError
+
+import main
+
+
+def test_cache_key_changes_with_agent_setup():
+    agent = main.build_agents()["planning"]
+    key = main.cache_key(agent)
+
+    assert key.startswith("PlanningAgent:")
+    assert main.cache_key(agent.clone()) == key
+    assert main.cache_key(agent.clone(instructions=agent.instructions + "!")) != key
+    assert main.cache_key(agent.clone(model=main.get_special_model())) != key
+
+
+class FakeTavily:
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+
+    async def search(self, query, max_results):
+        self.calls.append(query)
+        if self.fail:
+            raise RuntimeError("boom")
+        return {"results": [{"title": query, "url": "https://example.com", "content": "snippet", "score": 1}]}
+
+
+@pytest.fixture
+def tavily(monkeypatch):
+    fake = FakeTavily()
+
+    async def no_wait():
+        pass
+
+    monkeypatch.setattr(main, "get_tavily", lambda: fake)
+    monkeypatch.setattr(main, "_tavily_slot", no_wait)
+    main._search_cache.clear()
+    yield fake
+    main._search_cache.clear()
+
+
+def test_search_repeated_query_hits_cache(tavily):
+    first = asyncio.run(main._search("Lead Generation", 5))
+    second = asyncio.run(main._search("  lead generation ", 5))
+
+    assert first == second
+    assert tavily.calls == ["Lead Generation"]
+
+
+def test_search_cache_expires(tavily, monkeypatch):
+    asyncio.run(main._search("q", 5))
+    real_monotonic = time.monotonic
+    monkeypatch.setattr(time, "monotonic", lambda: real_monotonic() + main.SEARCH_CACHE_TTL + 1)
+    asyncio.run(main._search("q", 5))
+
+    assert tavily.calls == ["q", "q"]
+
+
+def test_search_failures_are_not_cached(tavily):
+    tavily.fail = True
+    assert asyncio.run(main._search("q", 5)).startswith("WebSearchTool failed")
+
+    tavily.fail = False
+    assert not asyncio.run(main._search("q", 5)).startswith("WebSearchTool failed")
+    assert tavily.calls == ["q", "q"]
+
+
+def test_search_empty_results_are_cached(tavily, monkeypatch):
+    async def empty(query, max_results):
+        tavily.calls.append(query)
+        return {"results": []}
+
+    monkeypatch.setattr(tavily, "search", empty)
+    assert asyncio.run(main._search("q", 5)) == "No results found."
+    assert asyncio.run(main._search("q", 5)) == "No results found."
+    assert tavily.calls == ["q"]
+
+
+def test_search_cache_evicts_oldest_entry(tavily):
+    async def fill():
+        for i in range(main.SEARCH_CACHE_SIZE + 1):
+            await main._search(f"q{i}", 5)
+
+    asyncio.run(fill())
+    assert len(main._search_cache) == main.SEARCH_CACHE_SIZE
+    assert ("q0", 5) not in main._search_cache
+    assert ("q1", 5) in main._search_cache
+
+
+def test_search_many_dedupes_batch(tavily):
+    output = asyncio.run(main._search_many(["CRM tools", "crm tools ", "cold email"], 5))
+
+    assert tavily.calls == ["CRM tools", "cold email"]
+    assert output.count("### ") == 2
+
+
+def rate_limit_error(retry_after=None):
+    headers = {"retry-after": retry_after} if retry_after is not None else {}
+    request = httpx.Request("POST", "https://example.com")
+    response = httpx.Response(429, headers=headers, request=request)
+    return RateLimitError("quota", response=response, body=None)
+
+
+def test_retry_delay_prefers_larger_retry_after(monkeypatch):
+    monkeypatch.setattr(random, "uniform", lambda low, high: high)
+
+    assert main.retry_delay(rate_limit_error("30"), attempt=0, base_delay=5) == 30
+    assert main.retry_delay(rate_limit_error("1"), attempt=0, base_delay=5) == 5
+
+
+def test_retry_delay_ignores_non_numeric_retry_after(monkeypatch):
+    monkeypatch.setattr(random, "uniform", lambda low, high: high)
+    error = rate_limit_error("Wed, 21 Oct 2026 07:28:00 GMT")
+
+    assert main.retry_delay(error, attempt=2, base_delay=5) == 20
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    slept = []
+
+    async def fake_sleep(seconds):
+        slept.append(seconds)
+
+    monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+    return slept
+
+
+def test_safe_run_gives_up_after_max_retries(monkeypatch, sleeps):
+    calls = []
+
+    async def always_limited(agent, prompt, max_turns):
+        calls.append(prompt)
+        raise rate_limit_error()
+
+    monkeypatch.setattr(main.Runner, "run", always_limited)
+
+    with pytest.raises(Exception, match="Too many retries") as excinfo:
+        asyncio.run(main.safe_run(object(), "prompt", max_retries=3))
+
+    assert len(calls) == 3
+    assert len(sleeps) == 2
+    assert isinstance(excinfo.value.__cause__, RateLimitError)
+
+
+def test_safe_run_elapsed_cap_counts_only_sleep(monkeypatch, sleeps):
+    clock = [0.0]
+    calls = []
+
+    async def slow_and_limited(agent, prompt, max_turns):
+        clock[0] += 1000  # each attempt runs far longer than the retry cap
+        calls.append(prompt)
+        raise rate_limit_error()
+
+    monkeypatch.setattr(time, "monotonic", lambda: clock[0])
+    monkeypatch.setattr(main.Runner, "run", slow_and_limited)
+    monkeypatch.setattr(main, "retry_delay", lambda e, attempt, base_delay: 100.0)
+
+    with pytest.raises(Exception, match="Too many retries"):
+        asyncio.run(main.safe_run(object(), "prompt", max_retries=10))
+
+    assert sleeps == [100.0, 100.0, 100.0]
+    assert len(calls) == 4